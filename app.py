@@ -1,517 +1,795 @@
-import os
-import uuid
-import time
-import threading
-import logging
-from pathlib import Path
-from flask import Flask, render_template, request, jsonify, Response, stream_with_context
-from yt_dlp import YoutubeDL
-import mimetypes
-import requests
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
-app = Flask(__name__)
-app.secret_key = "your-secret-key-change-in-production"
-
-# Configuration
-DOWNLOAD_FOLDER = Path("downloads")
-DOWNLOAD_FOLDER.mkdir(exist_ok=True)
-MAX_FILE_AGE = 3600
-CLEANUP_INTERVAL = 300
-import shutil
-import os
-
-# Set OAuth2 token cache path to a writable location
-OAUTH_TOKEN_PATH = DOWNLOAD_FOLDER / "oauth2_token.json"
-os.environ['YOUTUBE_OAUTH2_TOKEN_PATH'] = str(OAUTH_TOKEN_PATH)
-
-
-def setup_oauth_token():
-    """Copy OAuth token from Render secrets to writable location"""
-    render_token = Path("/etc/secrets/oauth2_token.json")
-    
-    if render_token.exists() and not OAUTH_TOKEN_PATH.exists():
-        try:
-            shutil.copy(render_token, OAUTH_TOKEN_PATH)
-            logger.info(f"Copied OAuth token from {render_token} to {OAUTH_TOKEN_PATH}")
-        except Exception as e:
-            logger.error(f"Failed to copy OAuth token: {e}")
-
-
-def get_cookies_file():
-    """Get cookies file path - copy to writable location if needed"""
-    render_path = Path("/etc/secrets/cookies.txt")
-    local_path = Path("cookies.txt")
-    writable_path = DOWNLOAD_FOLDER / "cookies.txt"
-    
-    if writable_path.exists():
-        return writable_path
-    
-    if render_path.exists():
-        try:
-            shutil.copy(render_path, writable_path)
-            logger.info(f"Copied cookies from {render_path} to {writable_path}")
-            return writable_path
-        except Exception as e:
-            logger.error(f"Failed to copy cookies: {e}")
-            return None
-    elif local_path.exists():
-        logger.info(f"Using local cookies file: {local_path}")
-        return local_path
-    else:
-        logger.warning("No cookies.txt found")
-        return None
-
-
-# Initialize OAuth token on startup
-setup_oauth_token()
-
-
-def get_ydl_base_opts():
-    """Get base yt-dlp options with OAuth2 and cookie support for bot bypass"""
-    opts = {
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'en-us,en;q=0.5',
-            'Sec-Fetch-Mode': 'navigate',
-        },
-        # Use OAuth2 plugin for authentication (more reliable than cookies on servers)
-        'username': 'oauth2',
-        'password': '',
-        # Additional options to help bypass bot detection
-        'extractor_args': {
-            'youtube': {
-                'player_client': ['android', 'web'],
-            }
-        },
-        'socket_timeout': 30,
-        'quiet': False,
-        'verbose': True,  # Enable verbose logging for debugging
-    }
-    
-    # Also use cookies file if available as fallback
-    cookies_file = get_cookies_file()
-    if cookies_file:
-        opts['cookiefile'] = str(cookies_file)
-    
-    return opts
-
-# Thread-safe storage
-progress_lock = threading.Lock()
-progress_data = {}
-download_cache = {}
-
-
-# ------------------------- CLEANUP -------------------------
-def cleanup_old_files():
-    """Remove old downloaded files"""
-    while True:
-        try:
-            time.sleep(CLEANUP_INTERVAL)
-            current_time = time.time()
-            
-            for filepath in DOWNLOAD_FOLDER.iterdir():
-                if filepath.is_file():
-                    try:
-                        age = current_time - filepath.stat().st_mtime
-                        if age > MAX_FILE_AGE:
-                            filepath.unlink()
-                            logger.info(f"Cleaned up: {filepath.name}")
-                    except Exception as e:
-                        logger.error(f"Cleanup error for {filepath.name}: {e}")
-            
-            with progress_lock:
-                stale = [j for j, d in list(download_cache.items()) 
-                        if current_time - d.get("timestamp", 0) > MAX_FILE_AGE]
-                for job_id in stale:
-                    del download_cache[job_id]
-                    if job_id in progress_data:
-                        del progress_data[job_id]
-        
-        except Exception as e:
-            logger.error(f"Cleanup thread error: {e}")
-
-
-threading.Thread(target=cleanup_old_files, daemon=True).start()
-
-
-# ------------------------- HELPER FUNCTIONS -------------------------
-def create_progress_hook(job_id):
-    """Progress callback for yt-dlp"""
-    def hook(d):
-        try:
-            status = d.get('status')
-            
-            with progress_lock:
-                if job_id not in progress_data:
-                    progress_data[job_id] = {}
-                
-                if status == 'downloading':
-                    total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                    downloaded = d.get('downloaded_bytes', 0)
-                    percent = int((downloaded / total) * 100) if total > 0 else 0
-                    
-                    progress_data[job_id].update({
-                        'status': 'downloading',
-                        'percent': percent,
-                        'speed': d.get('speed', 0),
-                        'eta': d.get('eta', 0)
-                    })
-                
-                elif status == 'finished':
-                    progress_data[job_id].update({
-                        'status': 'processing',
-                        'percent': 99
-                    })
-        except Exception as e:
-            logger.error(f"Progress hook error: {e}")
-    
-    return hook
-
-
-def get_video_info(url):
-    """Extract video information from URL"""
-    logger.info(f"Getting info for: {url}")
-    
-    ydl_opts = {
-        **get_ydl_base_opts(),
-        'quiet': False,
-        'no_warnings': False,
-        'skip_download': True,
-        'extract_flat': False,
-    }
-    
-    try:
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if not info:
-                raise ValueError("No video information found")
-            
-            logger.info(f"Got info for: {info.get('title', 'Unknown')}")
-            
-            # Extract formats
-            video_formats = []
-            audio_formats = []
-            
-            for fmt in info.get('formats', []):
-                format_id = fmt.get('format_id')
-                vcodec = fmt.get('vcodec', 'none')
-                acodec = fmt.get('acodec', 'none')
-                ext = fmt.get('ext', 'mp4')
-                height = fmt.get('height', 0)
-                abr = fmt.get('abr', 0)
-                filesize = fmt.get('filesize') or fmt.get('filesize_approx')
-                
-                # Video with audio
-                if vcodec != 'none' and acodec != 'none' and height:
-                    video_formats.append({
-                        'format_id': format_id,
-                        'quality': f"{height}p",
-                        'ext': ext,
-                        'filesize': filesize
-                    })
-                
-                # Audio only
-                elif acodec != 'none' and vcodec == 'none' and abr:
-                    audio_formats.append({
-                        'format_id': format_id,
-                        'quality': f"{int(abr)}kbps",
-                        'ext': ext,
-                        'filesize': filesize
-                    })
-            
-            # Remove duplicates and sort
-            seen = set()
-            unique_video = []
-            for fmt in video_formats:
-                key = fmt['quality']
-                if key not in seen:
-                    seen.add(key)
-                    unique_video.append(fmt)
-            
-            seen = set()
-            unique_audio = []
-            for fmt in audio_formats:
-                key = fmt['quality']
-                if key not in seen:
-                    seen.add(key)
-                    unique_audio.append(fmt)
-            
-            unique_video.sort(key=lambda x: int(x['quality'].replace('p', '')), reverse=True)
-            unique_audio.sort(key=lambda x: int(x['quality'].replace('kbps', '')), reverse=True)
-            
-            result = {
-                'title': info.get('title', 'Unknown'),
-                'thumbnail': info.get('thumbnail', ''),
-                'duration': info.get('duration', 0),
-                'channel': info.get('channel') or info.get('uploader', 'Unknown'),
-                'view_count': info.get('view_count', 0),
-                'video_formats': unique_video[:15],
-                'audio_formats': unique_audio[:10]
-            }
-            
-            logger.info(f"Returning {len(result['video_formats'])} video and {len(result['audio_formats'])} audio formats")
-            return result
-            
-    except Exception as e:
-        logger.error(f"Error getting video info: {e}", exc_info=True)
-        raise
-
-
-def download_video(url, format_id, mode, job_id, output_format=None):
-    """Download video/audio with optional format conversion"""
-    try:
-        with progress_lock:
-            progress_data[job_id] = {'status': 'starting', 'percent': 0}
-        
-        temp_file = DOWNLOAD_FOLDER / f"{job_id}.%(ext)s"
-        
-        ydl_opts = {
-            **get_ydl_base_opts(),
-            'outtmpl': str(temp_file),
-            'progress_hooks': [create_progress_hook(job_id)],
-            'quiet': False,
-            'no_warnings': False,
-        }
-        
-        if mode == 'audio':
-            # Audio mode - support mp3, aac, ogg
-            audio_format = output_format if output_format in ['mp3', 'aac', 'ogg', 'm4a'] else 'mp3'
-            ydl_opts['format'] = 'bestaudio/best'
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': audio_format,
-                'preferredquality': '192',
-            }]
-            ext = audio_format
-        else:
-            # Video mode - support mp4, mkv, webm
-            video_format = output_format if output_format in ['mp4', 'mkv', 'webm'] else 'mp4'
-            if format_id and format_id != 'best':
-                ydl_opts['format'] = f"{format_id}+bestaudio/best"
-            else:
-                ydl_opts['format'] = 'best'
-            
-            # Add merge output format for video
-            ydl_opts['merge_output_format'] = video_format
-            ext = video_format
-        
-        logger.info(f"Starting download for job {job_id}")
-        
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get('title', 'video')
-        
-        # Find downloaded file
-        downloaded_file = None
-        for f in DOWNLOAD_FOLDER.iterdir():
-            if f.name.startswith(job_id):
-                downloaded_file = f
-                break
-        
-        if not downloaded_file:
-            raise FileNotFoundError("Downloaded file not found")
-        
-        clean_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_'))[:100]
-        filename = f"{clean_title}.{ext}"
-        
-        with progress_lock:
-            download_cache[job_id] = {
-                'filepath': downloaded_file,
-                'filename': filename,
-                'size': downloaded_file.stat().st_size,
-                'timestamp': time.time(),
-                'mimetype': mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-            }
-            progress_data[job_id] = {'status': 'completed', 'percent': 100}
-        
-        logger.info(f"Download completed: {job_id}")
-        
-    except Exception as e:
-        logger.error(f"Download error for {job_id}: {e}", exc_info=True)
-        with progress_lock:
-            progress_data[job_id] = {'status': 'error', 'percent': 0, 'message': str(e)}
-
-
-# ------------------------- ROUTES -------------------------
-@app.route('/')
-def index():
-    """Main page"""
-    logger.info("Index page requested")
-    return render_template('index.html')
-
-
-@app.route('/process', methods=['POST'])
-def process():
-    """Process URL and get video info"""
-    try:
-        logger.info("Process endpoint called")
-        data = request.get_json()
-        logger.info(f"Request data: {data}")
-        
-        if not data or 'url' not in data:
-            return jsonify({'error': 'URL required'}), 400
-        
-        url = data['url'].strip()
-        logger.info(f"Processing URL: {url}")
-        
-        info = get_video_info(url)
-        return jsonify(info)
-        
-    except Exception as e:
-        logger.error(f"Process error: {e}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
-
-
-@app.route('/download', methods=['POST'])
-def download():
-    """Stream download directly to browser (no disk save)"""
-    try:
-        data = request.get_json()
-        url = data.get('url', '').strip()
-        format_id = data.get('format_id', 'best')
-        mode = data.get('mode', 'video')
-        output_format = data.get('output_format', None)  # mp4, mkv, webm for video; mp3, aac, ogg for audio
-
-        if not url:
-            return jsonify({'error': 'URL required'}), 400
-
-        # Extract format info (no download)
-        ydl_opts = {
-            **get_ydl_base_opts(),
-            'skip_download': True,
-            'quiet': True,
-        }
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-
-        # choose format
-        chosen = None
-        if format_id and format_id != 'best':
-            for fmt in info.get('formats', []):
-                if fmt.get('format_id') == format_id:
-                    chosen = fmt
-                    break
-
-        if not chosen:
-            # heuristics: prefer progressive (has both audio+video) for video, best audio for audio mode
-            formats = info.get('formats', [])
-            if mode == 'audio':
-                # pick best audio
-                formats = sorted([f for f in formats if f.get('acodec') and f.get('acodec') != 'none'],
-                                 key=lambda x: x.get('abr') or 0, reverse=True)
-            else:
-                # pick best video with audio if possible
-                formats = sorted([f for f in formats if f.get('vcodec') and f.get('vcodec') != 'none'],
-                                 key=lambda x: (x.get('height') or 0, x.get('tbr') or 0), reverse=True)
-            chosen = formats[0] if formats else info
-
-        format_url = chosen.get('url') or info.get('url')
-        if not format_url:
-            return jsonify({'error': 'Could not get direct media URL (may require post-processing)'}), 400
-
-        # decide filename and mimetype
-        title = info.get('title', 'download')
-        ext = chosen.get('ext') or output_format or 'bin'
-        clean_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_'))[:100]
-        filename = f"{clean_title}.{ext}"
-        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-        filesize = chosen.get('filesize') or chosen.get('filesize_approx')
-
-        # stream remote content to client
-        remote = requests.get(format_url, stream=True, timeout=15)
-        remote.raise_for_status()
-
-        def generate():
-            try:
-                for chunk in remote.iter_content(chunk_size=8192):
-                    if chunk:
-                        yield chunk
-            finally:
-                try:
-                    remote.close()
-                except Exception:
-                    pass
-
-        headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
-        if filesize:
-            headers['Content-Length'] = str(filesize)
-
-        return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
-
-    except Exception as e:
-        logger.error(f"Download stream error: {e}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
-
-
-@app.route('/progress/<job_id>')
-def progress(job_id):
-    """Get progress"""
-    with progress_lock:
-        data = progress_data.get(job_id, {'status': 'unknown', 'percent': 0})
-    return jsonify(data)
-
-
-@app.route('/file/<job_id>')
-def file(job_id):
-    """Download file"""
-    try:
-        with progress_lock:
-            cache = download_cache.get(job_id)
-        
-        if not cache:
-            return jsonify({'error': 'File not found'}), 404
-        
-        filepath = cache['filepath']
-        if not filepath.exists():
-            return jsonify({'error': 'File not found'}), 404
-        
-        def generate():
-            with open(filepath, 'rb') as f:
-                while True:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    yield chunk
-        
-        response = Response(stream_with_context(generate()), mimetype=cache['mimetype'])
-        response.headers['Content-Disposition'] = f'attachment; filename="{cache["filename"]}"'
-        response.headers['Content-Length'] = str(cache['size'])
-        
-        return response
-        
-    except Exception as e:
-        logger.error(f"File serve error: {e}")
-        return jsonify({'error': str(e)}), 500
-
-
-@app.route('/health')
-def health():
-    """Health check"""
-    return jsonify({'status': 'ok'})
-
-
-# Error handlers
-@app.errorhandler(404)
-def not_found(e):
-    logger.warning(f"404 error: {request.url}")
-    return jsonify({'error': 'Not found'}), 404
-
-
-@app.errorhandler(500)
-def server_error(e):
-    logger.error(f"500 error: {e}")
-    return jsonify({'error': 'Server error'}), 500
-
-
-if __name__ == '__main__':
-    logger.info("Starting Flask app...")
-    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
+# Patch before anything else is imported: the module-level locks, the
+# download pool, and the urllib3 sockets must all be cooperative under
+# the gunicorn gevent workers, and the worker itself only patches after
+# this module would already have been loaded
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import re
+import json
+import time
+import secrets
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from flask import Flask, render_template, request, jsonify, Response, send_file, stream_with_context
+from werkzeug.wsgi import wrap_file
+from yt_dlp import YoutubeDL
+import urllib3
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# yt-dlp formats a log line per fragment and progress tick; keep that
+# noise off the hot path (progress is captured via progress_hooks)
+logging.getLogger('yt_dlp').setLevel(logging.WARNING)
+
+app = Flask(__name__)
+app.secret_key = "your-secret-key-change-in-production"
+
+# Configuration
+DOWNLOAD_FOLDER = Path("downloads")
+DOWNLOAD_FOLDER.mkdir(exist_ok=True)
+MAX_FILE_AGE = 3600
+CLEANUP_INTERVAL = 300
+STREAM_CHUNK = 1 << 20  # buffer size for proxied media streams
+import shutil
+import os
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
+
+# Shared connection pool for proxying media bytes - keeps TLS sessions and
+# keep-alive connections to the CDN hosts alive across requests
+HTTP = urllib3.PoolManager(
+    num_pools=16,
+    maxsize=32,
+    headers={'User-Agent': USER_AGENT},
+)
+
+# Set OAuth2 token cache path to a writable location
+OAUTH_TOKEN_PATH = DOWNLOAD_FOLDER / "oauth2_token.json"
+os.environ['YOUTUBE_OAUTH2_TOKEN_PATH'] = str(OAUTH_TOKEN_PATH)
+
+
+def setup_oauth_token():
+    """Copy OAuth token from Render secrets to writable location"""
+    render_token = Path("/etc/secrets/oauth2_token.json")
+    
+    if render_token.exists() and not OAUTH_TOKEN_PATH.exists():
+        try:
+            shutil.copy(render_token, OAUTH_TOKEN_PATH)
+            logger.info(f"Copied OAuth token from {render_token} to {OAUTH_TOKEN_PATH}")
+        except Exception as e:
+            logger.error(f"Failed to copy OAuth token: {e}")
+
+
+def get_cookies_file():
+    """Get cookies file path - copy to writable location if needed"""
+    render_path = Path("/etc/secrets/cookies.txt")
+    local_path = Path("cookies.txt")
+    writable_path = DOWNLOAD_FOLDER / "cookies.txt"
+    
+    if writable_path.exists():
+        return writable_path
+    
+    if render_path.exists():
+        try:
+            shutil.copy(render_path, writable_path)
+            logger.info(f"Copied cookies from {render_path} to {writable_path}")
+            return writable_path
+        except Exception as e:
+            logger.error(f"Failed to copy cookies: {e}")
+            return None
+    elif local_path.exists():
+        logger.info(f"Using local cookies file: {local_path}")
+        return local_path
+    else:
+        logger.warning("No cookies.txt found")
+        return None
+
+
+# Initialize OAuth token on startup
+setup_oauth_token()
+
+
+def _build_base_ydl_opts():
+    """Build base yt-dlp options with OAuth2 and cookie support for bot bypass"""
+    opts = {
+        'http_headers': {
+            'User-Agent': USER_AGENT,
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-us,en;q=0.5',
+            'Sec-Fetch-Mode': 'navigate',
+        },
+        # Use OAuth2 plugin for authentication (more reliable than cookies on servers)
+        'username': 'oauth2',
+        'password': '',
+        # Additional options to help bypass bot detection
+        'extractor_args': {
+            'youtube': {
+                'player_client': ['android', 'web'],
+            }
+        },
+        'socket_timeout': 30,
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+    }
+    
+    # Also use cookies file if available as fallback
+    cookies_file = get_cookies_file()
+    if cookies_file:
+        opts['cookiefile'] = str(cookies_file)
+
+    return opts
+
+
+# The cookies location can't change at runtime, so build the options once
+# instead of re-checking the filesystem on every request
+_BASE_YDL_OPTS = _build_base_ydl_opts()
+
+
+def get_ydl_base_opts():
+    """Get base yt-dlp options; callers spread-copy before mutating"""
+    return _BASE_YDL_OPTS
+
+
+# Shared extractor instance for metadata-only calls: constructing a
+# YoutubeDL builds the whole extractor chain, cookie jar, and opener on
+# every call, which is pure setup cost. yt-dlp isn't reentrant, so calls
+# are serialized behind _YDL_LOCK. Download jobs still build their own
+# instance because they need per-job outtmpl and progress_hooks.
+_YDL_INFO = YoutubeDL({
+    **_BASE_YDL_OPTS,
+    'skip_download': True,
+    'extract_flat': False,
+})
+_YDL_LOCK = threading.Lock()
+
+# Thread-safe storage. progress_data values are replaced wholesale with
+# single-key dict assignments, which are atomic under the GIL, so the
+# progress hook never contends on a lock; progress_lock only guards the
+# multi-step maps (info_cache, inflight) and download_cache_lock guards
+# download_cache mutations. Convention: single-key reads (dict.get) are
+# done without a lock everywhere - locks are for multi-step updates only.
+progress_lock = threading.Lock()
+download_cache_lock = threading.Lock()
+progress_data = {}
+download_cache = {}
+info_cache = {}
+INFO_CACHE_TTL = 600
+inflight = {}  # (url, format_id, mode, output_format) -> job_id
+progress_events = {}  # job_id -> threading.Condition, for SSE push
+
+# Bounded worker pool for download jobs - an unbounded thread per job
+# would let a burst of requests exhaust memory and YouTube quota
+DOWNLOAD_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DL_WORKERS", "4")),
+    thread_name_prefix="dl",
+)
+
+
+# ------------------------- CLEANUP -------------------------
+def cleanup_old_files():
+    """Remove old downloaded files"""
+    while True:
+        try:
+            time.sleep(CLEANUP_INTERVAL)
+            current_time = time.time()
+            
+            # os.scandir reuses the stat data fetched by readdir itself,
+            # avoiding an extra stat syscall per file
+            with os.scandir(DOWNLOAD_FOLDER) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
+                        try:
+                            age = current_time - entry.stat(follow_symlinks=False).st_mtime
+                            if age > MAX_FILE_AGE:
+                                os.unlink(entry.path)
+                                logger.info(f"Cleaned up: {entry.name}")
+                        except Exception as e:
+                            logger.error(f"Cleanup error for {entry.name}: {e}")
+            
+            # Snapshot entries first; only the download_cache deletes need a lock
+            stale = [(j, d) for j, d in list(download_cache.items())
+                    if current_time - d.get("timestamp", 0) > MAX_FILE_AGE]
+            with download_cache_lock:
+                for job_id, _ in stale:
+                    download_cache.pop(job_id, None)
+            for job_id, entry in stale:
+                progress_data.pop(job_id, None)
+                progress_events.pop(job_id, None)
+                # The cache already knows the file path; unlink it directly
+                # instead of waiting for the age scan to find it
+                filepath = entry.get('filepath')
+                try:
+                    if filepath and filepath.exists():
+                        filepath.unlink()
+                        logger.info(f"Cleaned up: {filepath.name}")
+                except Exception as e:
+                    logger.error(f"Cleanup error for {job_id}: {e}")
+
+            # Errored jobs never enter download_cache, so age their
+            # timestamped progress entries out here
+            stale_jobs = [j for j, d in list(progress_data.items())
+                          if d.get('status') == 'error'
+                          and current_time - d.get('timestamp', 0) > MAX_FILE_AGE]
+            for job_id in stale_jobs:
+                progress_data.pop(job_id, None)
+                progress_events.pop(job_id, None)
+
+            with progress_lock:
+                stale_info = [u for u, (ts, _) in list(info_cache.items())
+                              if current_time - ts > INFO_CACHE_TTL]
+                for url in stale_info:
+                    del info_cache[url]
+        
+        except Exception as e:
+            logger.error(f"Cleanup thread error: {e}")
+
+
+threading.Thread(target=cleanup_old_files, daemon=True).start()
+
+
+# ------------------------- HELPER FUNCTIONS -------------------------
+# \w keeps Unicode letters and digits like the old isalnum() filter did;
+# only punctuation and other filesystem-hostile characters are stripped
+_CLEAN_TITLE_RE = re.compile(r'[^\w \-]+')
+
+# The app only ever serves these extensions; a dict lookup beats
+# mimetypes.guess_type's lazy /etc/mime.types load and list scan
+_MIME = {
+    'mp4': 'video/mp4',
+    'mkv': 'video/x-matroska',
+    'webm': 'video/webm',
+    'mp3': 'audio/mpeg',
+    'aac': 'audio/aac',
+    'ogg': 'audio/ogg',
+    'm4a': 'audio/mp4',
+}
+
+
+def _clean_title(title):
+    """Sanitize a video title into a safe download filename stem"""
+    return _CLEAN_TITLE_RE.sub('', title)[:100].strip() or 'download'
+
+
+def _notify_progress(job_id):
+    """Wake any SSE streams waiting on this job's progress"""
+    cond = progress_events.get(job_id)
+    if cond:
+        with cond:
+            cond.notify_all()
+
+
+def create_progress_hook(job_id):
+    """Progress callback for yt-dlp"""
+    last = [-1, 0.0]  # last reported percent, last report time
+
+    def hook(d):
+        try:
+            status = d.get('status')
+
+            # Build the new state and swap it in whole; no lock needed
+            if status == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+                downloaded = d.get('downloaded_bytes', 0)
+                percent = int((downloaded / total) * 100) if total > 0 else 0
+
+                # yt-dlp can fire hundreds of times a second on a fast
+                # link; skip updates the UI can't distinguish anyway
+                now = time.monotonic()
+                if percent == last[0] and now - last[1] < 0.2:
+                    return
+                last[0] = percent
+                last[1] = now
+
+                progress_data[job_id] = {
+                    'status': 'downloading',
+                    'percent': percent,
+                    'speed': d.get('speed', 0),
+                    'eta': d.get('eta', 0)
+                }
+
+            elif status == 'finished':
+                progress_data[job_id] = {
+                    'status': 'processing',
+                    'percent': 99
+                }
+
+            _notify_progress(job_id)
+        except Exception as e:
+            logger.error(f"Progress hook error: {e}")
+    
+    return hook
+
+
+def _extract_info(url):
+    """Extract metadata for a URL, reusing a recent cached result.
+
+    /process and /download both need the same extraction; the client
+    typically calls them back to back, so caching avoids a second network
+    round-trip to YouTube (and the rate-limit exposure that goes with it).
+    """
+    now = time.time()
+    with progress_lock:
+        cached = info_cache.get(url)
+        if cached and now - cached[0] < INFO_CACHE_TTL:
+            logger.info(f"Info cache hit for: {url}")
+            return cached[1]
+
+    with _YDL_LOCK:
+        info = _YDL_INFO.extract_info(url, download=False)
+
+    if info:
+        with progress_lock:
+            info_cache[url] = (time.time(), info)
+
+    return info
+
+
+def get_video_info(url):
+    """Extract video information from URL"""
+    logger.info(f"Getting info for: {url}")
+
+    try:
+        info = _extract_info(url)
+
+        if not info:
+            raise ValueError("No video information found")
+
+        logger.info(f"Got info for: {info.get('title', 'Unknown')}")
+
+        # Extract formats: single pass keeping the best (largest) entry
+        # per quality, keyed on the numeric height/bitrate so the final
+        # sort doesn't re-parse the quality label
+        best_video = {}
+        best_audio = {}
+
+        for fmt in info.get('formats', []):
+            format_id = fmt.get('format_id')
+            vcodec = fmt.get('vcodec', 'none')
+            acodec = fmt.get('acodec', 'none')
+            ext = fmt.get('ext', 'mp4')
+            height = fmt.get('height', 0)
+            abr = fmt.get('abr', 0)
+            filesize = fmt.get('filesize') or fmt.get('filesize_approx')
+
+            # Video with audio
+            if vcodec != 'none' and acodec != 'none' and height:
+                current = best_video.get(height)
+                if current is None or (filesize or 0) > (current['filesize'] or 0):
+                    best_video[height] = {
+                        'format_id': format_id,
+                        'quality': f"{height}p",
+                        'ext': ext,
+                        'filesize': filesize
+                    }
+
+            # Audio only
+            elif acodec != 'none' and vcodec == 'none' and abr:
+                abr = int(abr)
+                current = best_audio.get(abr)
+                if current is None or (filesize or 0) > (current['filesize'] or 0):
+                    best_audio[abr] = {
+                        'format_id': format_id,
+                        'quality': f"{abr}kbps",
+                        'ext': ext,
+                        'filesize': filesize
+                    }
+
+        unique_video = [f for _, f in sorted(best_video.items(), reverse=True)]
+        unique_audio = [f for _, f in sorted(best_audio.items(), reverse=True)]
+        
+        result = {
+            'title': info.get('title', 'Unknown'),
+            'thumbnail': info.get('thumbnail', ''),
+            'duration': info.get('duration', 0),
+            'channel': info.get('channel') or info.get('uploader', 'Unknown'),
+            'view_count': info.get('view_count', 0),
+            'video_formats': unique_video[:15],
+            'audio_formats': unique_audio[:10]
+        }
+        
+        logger.info(f"Returning {len(result['video_formats'])} video and {len(result['audio_formats'])} audio formats")
+        return result
+        
+    except Exception as e:
+        logger.error(f"Error getting video info: {e}", exc_info=True)
+        raise
+
+
+def download_video(url, format_id, mode, job_id, output_format=None):
+    """Download video/audio with optional format conversion"""
+    job_key = (url, format_id, mode, output_format)
+    try:
+        progress_data[job_id] = {'status': 'starting', 'percent': 0}
+        
+        temp_file = DOWNLOAD_FOLDER / f"{job_id}.%(ext)s"
+        
+        ydl_opts = {
+            **get_ydl_base_opts(),
+            'outtmpl': str(temp_file),
+            'progress_hooks': [create_progress_hook(job_id)],
+        }
+        
+        if mode == 'audio':
+            # Audio mode - support mp3, aac, ogg
+            audio_format = output_format if output_format in ['mp3', 'aac', 'ogg', 'm4a'] else 'mp3'
+            ydl_opts['format'] = 'bestaudio/best'
+            ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': audio_format,
+                'preferredquality': '192',
+            }]
+            ext = audio_format
+        else:
+            # Video mode - support mp4, mkv, webm
+            video_format = output_format if output_format in ['mp4', 'mkv', 'webm'] else 'mp4'
+            if format_id and format_id != 'best':
+                ydl_opts['format'] = f"{format_id}+bestaudio/best"
+            else:
+                ydl_opts['format'] = 'best'
+            
+            # Add merge output format for video
+            ydl_opts['merge_output_format'] = video_format
+            ext = video_format
+        
+        logger.info(f"Starting download for job {job_id}")
+        
+        with YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=True)
+            title = info.get('title', 'video')
+
+            # yt-dlp reports the final path (including any postprocessor
+            # extension change) directly; no need to scan the folder
+            requested = info.get('requested_downloads') or []
+            if requested and requested[0].get('filepath'):
+                downloaded_file = Path(requested[0]['filepath'])
+            else:
+                downloaded_file = Path(ydl.prepare_filename(info))
+
+        if not downloaded_file.exists():
+            raise FileNotFoundError("Downloaded file not found")
+        
+        filename = f"{_clean_title(title)}.{ext}"
+
+        with download_cache_lock:
+            download_cache[job_id] = {
+                'filepath': downloaded_file,
+                'filename': filename,
+                'size': downloaded_file.stat().st_size,
+                'timestamp': time.time(),
+                'mimetype': _MIME.get(ext, 'application/octet-stream')
+            }
+        progress_data[job_id] = {'status': 'completed', 'percent': 100}
+
+        _notify_progress(job_id)
+        logger.info(f"Download completed: {job_id}")
+        
+    except Exception as e:
+        logger.error(f"Download error for {job_id}: {e}", exc_info=True)
+        # Errored jobs never reach download_cache, so stamp the entry for
+        # the cleanup sweep to age out
+        progress_data[job_id] = {'status': 'error', 'percent': 0,
+                                 'message': str(e), 'timestamp': time.time()}
+        _notify_progress(job_id)
+    finally:
+        with progress_lock:
+            if inflight.get(job_key) == job_id:
+                del inflight[job_key]
+
+
+def _choose_format(info, format_id, mode):
+    """Pick the format entry to stream for a direct download"""
+    if format_id and format_id != 'best':
+        for fmt in info.get('formats', []):
+            if fmt.get('format_id') == format_id:
+                return fmt
+
+    # heuristics: prefer progressive (has both audio+video) for video, best audio for audio mode
+    formats = info.get('formats', [])
+    if mode == 'audio':
+        # pick best audio
+        formats = sorted([f for f in formats if f.get('acodec') and f.get('acodec') != 'none'],
+                         key=lambda x: x.get('abr') or 0, reverse=True)
+    else:
+        # pick best video with audio if possible
+        formats = sorted([f for f in formats if f.get('vcodec') and f.get('vcodec') != 'none'],
+                         key=lambda x: (x.get('height') or 0, x.get('tbr') or 0), reverse=True)
+    return formats[0] if formats else info
+
+
+def _stream_format(info, chosen, format_url, output_format):
+    """Proxy a chosen format from its direct URL straight to the client"""
+    # decide filename and mimetype
+    title = info.get('title', 'download')
+    ext = chosen.get('ext') or output_format or 'bin'
+    filename = f"{_clean_title(title)}.{ext}"
+    mimetype = _MIME.get(ext, 'application/octet-stream')
+    filesize = chosen.get('filesize') or chosen.get('filesize_approx')
+
+    # Forward a client Range request to the CDN so a resumed download
+    # only transfers the missing bytes
+    req_headers = {'User-Agent': USER_AGENT}
+    range_header = request.headers.get('Range')
+    if range_header:
+        req_headers['Range'] = range_header
+
+    # stream remote content to client - hand the raw upstream socket to
+    # the WSGI layer so servers with wsgi.file_wrapper can use
+    # sendfile(2) instead of copying every chunk through Python
+    remote = HTTP.request(
+        'GET', format_url,
+        headers=req_headers,
+        preload_content=False,
+        decode_content=False,
+        timeout=urllib3.Timeout(connect=15.0, read=30.0),
+    )
+    if remote.status >= 400:
+        # Drain the (small) error body so the connection goes back to the
+        # pool in a reusable state rather than mid-response
+        remote.drain_conn()
+        return jsonify({'error': f'Upstream returned HTTP {remote.status}'}), 502
+
+    headers = {
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Accept-Ranges': 'bytes',
+    }
+    upstream_length = remote.headers.get('Content-Length')
+    if upstream_length:
+        headers['Content-Length'] = upstream_length
+    elif filesize:
+        headers['Content-Length'] = str(filesize)
+    content_range = remote.headers.get('Content-Range')
+    if content_range:
+        headers['Content-Range'] = content_range
+
+    stream = wrap_file(request.environ, remote, buffer_size=STREAM_CHUNK)
+    return Response(stream, status=remote.status, mimetype=mimetype,
+                    headers=headers, direct_passthrough=True)
+
+
+def _streamable_format(info, format_id, mode, output_format):
+    """Return (chosen, format_url) when a job can bypass the disk cache.
+
+    Only progressive video formats that already match the requested
+    container qualify; anything needing an ffmpeg merge or audio extract
+    has to go through the real file path in download_video.
+    """
+    if mode != 'video':
+        return None
+
+    chosen = _choose_format(info, format_id, mode)
+    if chosen.get('vcodec') in (None, 'none') or chosen.get('acodec') in (None, 'none'):
+        return None
+
+    if output_format and chosen.get('ext') != output_format:
+        return None
+
+    format_url = chosen.get('url') or info.get('url')
+    if not format_url:
+        return None
+
+    return chosen, format_url
+
+
+# ------------------------- ROUTES -------------------------
+@app.route('/')
+def index():
+    """Main page"""
+    logger.info("Index page requested")
+    return render_template('index.html')
+
+
+@app.route('/process', methods=['POST'])
+def process():
+    """Process URL and get video info"""
+    try:
+        logger.info("Process endpoint called")
+        data = request.get_json()
+
+        if not data or 'url' not in data:
+            return jsonify({'error': 'URL required'}), 400
+        
+        url = data['url'].strip()
+        logger.info(f"Processing URL: {url}")
+        
+        info = get_video_info(url)
+        return jsonify(info)
+        
+    except Exception as e:
+        logger.error(f"Process error: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/download', methods=['POST'])
+def download():
+    """Stream download directly to browser (no disk save)"""
+    try:
+        data = request.get_json()
+        url = data.get('url', '').strip()
+        format_id = data.get('format_id', 'best')
+        mode = data.get('mode', 'video')
+        output_format = data.get('output_format', None)  # mp4, mkv, webm for video; mp3, aac, ogg for audio
+
+        if not url:
+            return jsonify({'error': 'URL required'}), 400
+
+        # Extract format info (no download) - reuses the cached result
+        # from /process when the client just called it
+        info = _extract_info(url)
+        chosen = _choose_format(info, format_id, mode)
+
+        format_url = chosen.get('url') or info.get('url')
+        if not format_url:
+            return jsonify({'error': 'Could not get direct media URL (may require post-processing)'}), 400
+
+        return _stream_format(info, chosen, format_url, output_format)
+
+    except Exception as e:
+        logger.error(f"Download stream error: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/download_async', methods=['POST'])
+def download_async():
+    """Queue a server-side download job instead of blocking the request.
+
+    Returns a job_id immediately; the client polls /progress/<job_id> and
+    fetches the result from /file/<job_id> once completed. Needed for
+    anything that requires post-processing (ffmpeg merge/extract), which
+    the direct /download stream cannot do.
+    """
+    try:
+        data = request.get_json()
+        url = data.get('url', '').strip()
+        format_id = data.get('format_id', 'best')
+        mode = data.get('mode', 'video')
+        output_format = data.get('output_format', None)
+
+        if not url:
+            return jsonify({'error': 'URL required'}), 400
+
+        # If the chosen format is progressive and needs no conversion,
+        # stream it straight through instead of paying the disk
+        # round-trip (download to downloads/, then re-read in /file)
+        try:
+            info = _extract_info(url)
+            streamable = _streamable_format(info, format_id, mode, output_format)
+            if streamable:
+                return _stream_format(info, streamable[0], streamable[1], output_format)
+        except Exception as e:
+            logger.warning(f"Direct stream unavailable, queueing job: {e}")
+
+        # Single-flight: collapse concurrent identical requests onto the
+        # job that is already running rather than downloading twice
+        job_key = (url, format_id, mode, output_format)
+        with progress_lock:
+            existing = inflight.get(job_key)
+            if existing is not None:
+                logger.info(f"Joining in-flight job {existing} for: {url}")
+                return jsonify({'job_id': existing})
+
+            job_id = secrets.token_urlsafe(8)
+            inflight[job_key] = job_id
+            progress_data[job_id] = {'status': 'queued', 'percent': 0}
+
+        DOWNLOAD_POOL.submit(download_video, url, format_id, mode, job_id, output_format)
+
+        logger.info(f"Queued download job {job_id} for: {url}")
+        return jsonify({'job_id': job_id})
+
+    except Exception as e:
+        logger.error(f"Download queue error: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/progress/<job_id>')
+def progress(job_id):
+    """Get progress"""
+    # Lock-free read: dict.get is atomic under the GIL and writers swap
+    # whole values, so there is no partial state to observe
+    data = progress_data.get(job_id) or {'status': 'unknown', 'percent': 0}
+    return jsonify(data)
+
+
+@app.route('/progress_stream/<job_id>')
+def progress_stream(job_id):
+    """Push progress over Server-Sent Events instead of client polling"""
+    if job_id not in progress_data and job_id not in download_cache:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    cond = progress_events.setdefault(job_id, threading.Condition())
+
+    def generate():
+        unknown_streak = 0
+        while True:
+            data = progress_data.get(job_id) or {'status': 'unknown', 'percent': 0}
+
+            yield f"data: {json.dumps(data)}\n\n"
+
+            if data.get('status') in ('completed', 'error'):
+                # Every listener sees the terminal event before exiting,
+                # so the shared Condition can go; an abandoned one is
+                # reaped by the cleanup sweep instead of being popped
+                # here, where it would strand other live listeners
+                progress_events.pop(job_id, None)
+                return
+
+            # The job can be evicted while we stream; don't emit
+            # 'unknown' keepalives forever once it is gone
+            if data.get('status') == 'unknown':
+                unknown_streak += 1
+                if unknown_streak >= 5:
+                    return
+            else:
+                unknown_streak = 0
+
+            # Wake on state change; the timeout is only a keepalive
+            # so a dead job can't hang the stream forever
+            with cond:
+                cond.wait(timeout=1.0)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+
+@app.route('/file/<job_id>')
+def file(job_id):
+    """Download file"""
+    try:
+        # Lock-free read; filepath.exists() below is the authoritative check
+        cache = download_cache.get(job_id)
+
+        if not cache:
+            return jsonify({'error': 'File not found'}), 404
+        
+        filepath = cache['filepath']
+        if not filepath.exists():
+            return jsonify({'error': 'File not found'}), 404
+
+        # send_file uses sendfile(2) under gunicorn/uwsgi instead of
+        # copying 8 KiB chunks through Python
+        return send_file(
+            filepath,
+            mimetype=cache['mimetype'],
+            as_attachment=True,
+            download_name=cache['filename'],
+            conditional=True,
+        )
+        
+    except Exception as e:
+        logger.error(f"File serve error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/health')
+def health():
+    """Health check"""
+    return jsonify({'status': 'ok'})
+
+
+# Error handlers
+@app.errorhandler(404)
+def not_found(e):
+    logger.warning(f"404 error: {request.url}")
+    return jsonify({'error': 'Not found'}), 404
+
+
+@app.errorhandler(500)
+def server_error(e):
+    logger.error(f"500 error: {e}")
+    return jsonify({'error': 'Server error'}), 500
+
+
+if __name__ == '__main__':
+    # Development entrypoint only - production runs under gunicorn with
+    # gevent workers (see Procfile)
+    logger.info("Starting Flask dev server...")
+    app.run(host='0.0.0.0', port=5000, debug=bool(os.getenv('FLASK_DEV')), threaded=True)